@@ -4,39 +4,151 @@
 """Functions for inspecting a view and extracting information."""
 
 
+# Keep imports light: heavier modules (multiprocessing, xml, json)
+# are imported where needed, for a fast startup of the command line tool.
+import array
 import collections
-import inspect
+import os
+import struct
 import sys
+import threading
+import time
+import types
+import weakref
+
+
+# Monotonic clock where available (Python 3), for budget deadlines.
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class Budget(object):
+    """Limits the amount of work done by a traversal.
+
+    A budget is shared by all steps of a traversal. Once a limit is reached,
+    the traversal skips the remaining work and returns what it found so far;
+    ``truncated`` then holds the name of the limit which was hit.
+
+    The same budget can be given to a Frame and to its walks (``unwrap``,
+    ``find_decorator``...): nodes are counted once, when the frame is built,
+    and walking them again only checks the deadline, shared by all steps.
+
+    Args:
+        max_nodes (int): maximum number of nested functions or code objects
+            visited below the entry point
+        max_depth (int): maximum nesting depth below the entry point
+        max_chains (int): maximum number of decorator chains
+        max_bytes (int): maximum size of the rendered output
+        timeout (float): maximum duration, in seconds
+    """
+
+    def __init__(self, max_nodes=None, max_depth=None, max_chains=None,
+            max_bytes=None, timeout=None):
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.max_chains = max_chains
+        self.max_bytes = max_bytes
+        self.deadline = None if timeout is None else _clock() + timeout
+        self.nodes = 0
+        self.chains = 0
+        self.bytes = 0
+        self.truncated = None
+        # Whether printers have written their truncation marker
+        self.closed = False
+
+    def _truncate(self, reason):
+        self.truncated = reason
+        return False
+
+    def _expired(self):
+        return self.deadline is not None and _clock() > self.deadline
+
+    def add_node(self, depth, counted=False):
+        """Accounts for visiting a node; returns False if over budget.
+
+        A node already counted only checks the deadline.
+        """
+        if counted:
+            return not self._expired() or self._truncate('timeout')
+        if self.max_depth is not None and depth > self.max_depth:
+            return self._truncate('max_depth')
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            return self._truncate('max_nodes')
+        if self._expired():
+            return self._truncate('timeout')
+        self.nodes += 1
+        return True
+
+    def add_chain(self):
+        """Accounts for returning a chain; returns False if over budget."""
+        if self.max_chains is not None and self.chains >= self.max_chains:
+            return self._truncate('max_chains')
+        if self._expired():
+            return self._truncate('timeout')
+        self.chains += 1
+        return True
+
+    def add_bytes(self, size):
+        """Accounts for writing some output; returns False if over budget."""
+        if self.max_bytes is not None and self.bytes + size > self.max_bytes:
+            # No further output once the limit has been reached.
+            self.bytes = self.max_bytes
+            return self._truncate('max_bytes')
+        if self._expired():
+            return self._truncate('timeout')
+        self.bytes += size
+        return True
 
 
 class BasePrinter(object):
-    def __init__(self, out=None, prefix='', first_prefix=None, *args, **kwargs):
+    def __init__(self, out=None, prefix='', first_prefix=None, budget=None, depth=0,
+            *args, **kwargs):
         self.out = out or sys.stdout
         self.prefix = prefix
         if first_prefix is None:
             first_prefix = prefix
         self.first_prefix = first_prefix
+        self.budget = budget
+        self.depth = depth
         self._first_write_done = False
 
-    def _write(self, txt, auto_eol=True):
+    def _write(self, txt, auto_eol=True, force=False):
         suffix = '\n' if auto_eol else ''
         prefix = self.prefix
         if not self._first_write_done:
             self._first_write_done = True
             prefix = self.first_prefix
 
-        self.out.write('%s%s%s' % (prefix, txt, suffix))
+        line = '%s%s%s' % (prefix, txt, suffix)
+        if not force and self.budget is not None and not self.budget.add_bytes(len(line)):
+            self._close()
+            return
+        self.out.write(line)
+
+    def _close(self):
+        """Writes the truncation marker, once per budget."""
+        if not self.budget.closed:
+            self.budget.closed = True
+            self.out.write('%s\n' % self._truncation_marker(self.budget.truncated))
+
+    def _truncation_marker(self, reason):
+        return '%s[truncated: %s]' % (self.prefix, reason)
+
+    def _add_node(self):
+        """Accounts for rendering a nested node; returns False if over budget."""
+        return self.budget is None or self.budget.add_node(self.depth + 1)
 
 
 class FunctionPrinter(BasePrinter):
     def __init__(self, fun, *args, **kwargs):
+        self.source_lines = kwargs.pop('source_lines', 0)
         super(FunctionPrinter, self).__init__(*args, **kwargs)
         self.fun = fun
 
     def render(self):
         self._write('Function %s at %d, from %s' % (self.fun.__name__, id(self.fun), self.fun.__module__))
         code_printer = CodePrinter(self.fun.__code__,
-            out=self.out, prefix=self.prefix + '|   ', first_prefix=self.prefix + '+-> ')
+            out=self.out, prefix=self.prefix + '|   ', first_prefix=self.prefix + '+-> ',
+            budget=self.budget, depth=self.depth, source_lines=self.source_lines)
         code_printer.render()
         if self.fun.__closure__:
             self._write('|')
@@ -45,33 +157,37 @@ class FunctionPrinter(BasePrinter):
     def _write_closure(self):
         self._write('+-> Closure:')
 
-        for varname, varvalue in sorted(zip(self.fun.__code__.co_freevars, self.fun.__closure__)):
-            if callable(varvalue.cell_contents):
-                subprinter = FunctionPrinter(varvalue.cell_contents,
+        for varname, value in sorted(read_closure(self.fun), key=lambda item: item[0]):
+            if not callable(value):
+                self._write('|   +-> %s = %r' % (varname, value))
+            elif self._add_node():
+                subprinter = FunctionPrinter(value,
                     out=self.out, prefix=self.prefix + '|   |     ',
-                    first_prefix=self.prefix + '|   +-> %s = ' % varname)
+                    first_prefix=self.prefix + '|   +-> %s = ' % varname,
+                    budget=self.budget, depth=self.depth + 1, source_lines=self.source_lines)
                 subprinter.render()
             else:
-                self._write('|   +-> %s = %r' % (varname, varvalue.cell_contents))
+                self._write('|   +-> %s = [truncated: %s]' % (varname, self.budget.truncated))
 
 class CodePrinter(BasePrinter):
-    """Inspect and prints all code elements of a given function."""
+    """Inspect and prints all code elements of a given function.
+
+    With source_lines, the decorators and first lines of the source of each
+    code object are printed too, read through source_cache.
+    """
 
     def __init__(self, code, *args, **kwargs):
+        self.source_lines = kwargs.pop('source_lines', 0)
+        self.source_cache = kwargs.pop('source_cache', None) or source_cache
         super(CodePrinter, self).__init__(*args, **kwargs)
         self.code = code
 
     def render(self):
-        base_args = list(self.code.co_varnames[:self.code.co_argcount])
-        internal_vars = list(self.code.co_varnames[self.code.co_argcount:])
-        if self.code.co_flags & 0x04:  # Using '*args'
-            base_args.append('*%s' % internal_vars.pop(0))
-
-        if self.code.co_flags & 0x08:  # Using **kwargs
-            base_args.append('**%s' % internal_vars.pop(0))
-
-        self._write('Code: %s(%s)'% (self.code.co_name, ', '.join(base_args)))
+        self._write('Code: %s%s'% (self.code.co_name, format_args(self.code)))
         self._write('| file: %s:%d' % (self.code.co_filename, self.code.co_firstlineno))
+        if self.source_lines:
+            for lineno, line in self.source_cache.snippet(self.code, self.source_lines):
+                self._write('| %5d  %s' % (lineno, line.rstrip()))
         if self.code.co_freevars:
             self._write('| reusing: %s' % ', '.join(self.code.co_freevars))
         if self.code.co_cellvars:
@@ -80,11 +196,236 @@ class CodePrinter(BasePrinter):
         subcodes = [c for c in self.code.co_consts if isinstance(c, self.code.__class__)]
         for subcode in subcodes:
             self._write('|')
+            if not self._add_node():
+                self._write('+-> [truncated: %s]' % self.budget.truncated)
+                continue
             subprinter = CodePrinter(subcode, out=self.out,
-                prefix=self.prefix + '|   ', first_prefix=self.prefix + '+-> ')
+                prefix=self.prefix + '|   ', first_prefix=self.prefix + '+-> ',
+                budget=self.budget, depth=self.depth + 1,
+                source_lines=self.source_lines, source_cache=self.source_cache)
             subprinter.render()
 
 
+class SourceCache(object):
+    """Per-file cache of source lines.
+
+    Like linecache, files are read once and reloaded only when their
+    modification time or size changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._files = {}  # filename => ((mtime, size), lines)
+
+    def getlines(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            # Not a file: source from a zip, the interactive prompt...
+            import linecache
+            return linecache.getlines(filename)
+
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._files.get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        lines = self._read(filename)
+        with self.lock:
+            self._files[filename] = (key, lines)
+        return lines
+
+    def _read(self, filename):
+        try:
+            from tokenize import open as open_source  # Honors encoding cookies
+        except ImportError:  # Python 2
+            open_source = open
+        try:
+            with open_source(filename) as f:
+                return f.readlines()
+        except (IOError, SyntaxError, UnicodeDecodeError):
+            return []
+
+    def snippet(self, code, nb_lines):
+        """Extracts the decorators and first nb_lines of a code object.
+
+        Returns:
+            (int, str) list: line numbers and source lines.
+        """
+        lines = self.getlines(code.co_filename)
+        start = code.co_firstlineno - 1
+        if start < 0 or start >= len(lines):
+            return []
+
+        # co_firstlineno points to the first decorator, if any; decorators
+        # last until the 'def' line, possibly spanning several lines.
+        end = start
+        if lines[start].lstrip().startswith('@'):
+            while end < len(lines) - 1 and not lines[end].lstrip().startswith(('def ', 'async def ')):
+                end += 1
+        end += nb_lines
+        return [(i + 1, lines[i]) for i in range(start, min(end, len(lines)))]
+
+
+source_cache = SourceCache()
+
+
+class GraphPrinter(BasePrinter):
+    """Streams the closure and code object graph of a function.
+
+    Nodes and edges are written as soon as they are discovered; functions and
+    code objects shared between several paths are written only once.
+    """
+
+    def __init__(self, fun, decorators=(), *args, **kwargs):
+        super(GraphPrinter, self).__init__(*args, **kwargs)
+        if isinstance(fun, Frame):
+            fun = fun.fun
+        self.fun = fun
+        self.code_to_decorator = map_code_objects(decorators)[0]
+
+    def render(self):
+        self._write_header()
+        seen = set()
+        pending = [(self.fun, 0)]
+        self._add_function(self.fun, seen)
+        while pending:
+            fun, depth = pending.pop()
+            self._add_code(fun, depth, seen)
+            for varname, value in read_closure(fun):
+                if not hasattr(value, '__code__'):
+                    continue
+                if id(value) not in seen:
+                    if self.budget is not None and not self.budget.add_node(depth + 1):
+                        continue
+                    self._add_function(value, seen)
+                    pending.append((value, depth + 1))
+                self._write_edge(self._function_id(fun), self._function_id(value), varname)
+        if self.budget is not None and self.budget.truncated:
+            self._close()
+        self._write_footer()
+
+    def _add_function(self, fun, seen):
+        seen.add(id(fun))
+        name = fun.__name__
+        if fun.__code__.co_name != name:
+            name = '%s/%s' % (name, fun.__code__.co_name)
+        self._write_node(self._function_id(fun), name, 'function',
+            self.code_to_decorator.get(fun.__code__))
+
+    def _add_code(self, fun, depth, seen):
+        """Writes the code of a function, along with all nested code objects."""
+        if id(fun.__code__) in seen:
+            self._write_edge(self._function_id(fun), self._code_id(fun.__code__), '')
+            return
+
+        seen.add(id(fun.__code__))
+        pending = [(fun.__code__, depth)]
+        self._write_code_node(fun.__code__)
+        self._write_edge(self._function_id(fun), self._code_id(fun.__code__), '')
+        while pending:
+            code, code_depth = pending.pop()
+            for subcode in code.co_consts:
+                if not isinstance(subcode, code.__class__) or id(subcode) in seen:
+                    continue
+                if self.budget is not None and not self.budget.add_node(code_depth + 1):
+                    continue
+                seen.add(id(subcode))
+                self._write_code_node(subcode)
+                self._write_edge(self._code_id(code), self._code_id(subcode), '')
+                pending.append((subcode, code_depth + 1))
+
+    def _write_code_node(self, code):
+        label = '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+        self._write_node(self._code_id(code), label, 'code',
+            self.code_to_decorator.get(code))
+
+    def _function_id(self, fun):
+        return 'f%d' % id(fun)
+
+    def _code_id(self, code):
+        return 'c%d' % id(code)
+
+    def _write_header(self):
+        raise NotImplementedError()
+
+    def _write_node(self, node_id, label, kind, decorator):
+        raise NotImplementedError()
+
+    def _write_edge(self, source, target, label):
+        raise NotImplementedError()
+
+    def _write_footer(self):
+        raise NotImplementedError()
+
+
+class DotPrinter(GraphPrinter):
+    """Writes the graph of a function in Graphviz' DOT format."""
+
+    def _quote(self, txt):
+        txt = txt.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '"%s"' % txt
+
+    def _write_header(self):
+        self._write('digraph inspector {', force=True)
+
+    def _truncation_marker(self, reason):
+        return '  // truncated: %s' % reason
+
+    def _write_node(self, node_id, label, kind, decorator):
+        attrs = ['shape=%s' % ('box' if kind == 'function' else 'ellipse')]
+        if decorator is not None:
+            label = '%s\n[%s]' % (label, decorator.__name__)
+            attrs.append('style=filled')
+        attrs.insert(0, 'label=%s' % self._quote(label))
+        self._write('  %s [%s];' % (self._quote(node_id), ', '.join(attrs)))
+
+    def _write_edge(self, source, target, label):
+        attrs = ''
+        if label:
+            attrs = ' [label=%s]' % self._quote(label)
+        self._write('  %s -> %s%s;' % (self._quote(source), self._quote(target), attrs))
+
+    def _write_footer(self):
+        self._write('}', force=True)
+
+
+class GraphMLPrinter(GraphPrinter):
+    """Writes the graph of a function in the GraphML format."""
+
+    def _write_header(self):
+        self._write('<?xml version="1.0" encoding="UTF-8"?>', force=True)
+        self._write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">', force=True)
+        self._write('  <key id="label" for="all" attr.name="label" attr.type="string"/>', force=True)
+        self._write('  <key id="kind" for="node" attr.name="kind" attr.type="string"/>', force=True)
+        self._write('  <key id="decorator" for="node" attr.name="decorator" attr.type="string"/>', force=True)
+        self._write('  <graph id="inspector" edgedefault="directed">', force=True)
+
+    def _truncation_marker(self, reason):
+        return '    <!-- truncated: %s -->' % reason
+
+    def _write_node(self, node_id, label, kind, decorator):
+        from xml.sax.saxutils import escape, quoteattr
+        data = [('label', label), ('kind', kind)]
+        if decorator is not None:
+            data.append(('decorator', decorator.__name__))
+        self._write('    <node id=%s>%s</node>' % (
+            quoteattr(node_id),
+            ''.join('<data key="%s">%s</data>' % (k, escape(v)) for k, v in data)))
+
+    def _write_edge(self, source, target, label):
+        from xml.sax.saxutils import escape, quoteattr
+        data = ''
+        if label:
+            data = '<data key="label">%s</data>' % escape(label)
+        self._write('    <edge source=%s target=%s>%s</edge>' % (
+            quoteattr(source), quoteattr(target), data))
+
+    def _write_footer(self):
+        self._write('  </graph>', force=True)
+        self._write('</graphml>', force=True)
+
+
 import functools
 def example1(selected, default):
     def decorator(fun):
@@ -131,84 +472,497 @@ def test4(x, *_args, **_kwargs):
     return x(*_args, **_kwargs)
 
 
-def extract_code_objects(function):
-    """Extracts all code objects from a given function."""
-    pending = [function.__code__]
+CO_VARARGS = 0x04
+CO_VARKEYWORDS = 0x08
+
+CodeArgs = collections.namedtuple('CodeArgs',
+    ['posonlyargs', 'args', 'varargs', 'kwonlyargs', 'varkw'])
+
+_code_args_cache = weakref.WeakKeyDictionary()
+
+
+def code_args(code):
+    """Lists the parameters of a code object, cached per code object.
+
+    Returns:
+        CodeArgs: names of positional-only and other positional parameters,
+            of the '*args' parameter (or None), keyword-only parameters and
+            of the '**kwargs' parameter (or None).
+    """
+    try:
+        return _code_args_cache[code]
+    except KeyError:
+        pass
+
+    names = code.co_varnames
+    nb_posonly = getattr(code, 'co_posonlyargcount', 0)
+    nb_positional = code.co_argcount
+    nb_kwonly = getattr(code, 'co_kwonlyargcount', 0)
+    # Parameters come first in co_varnames: positional ones, keyword-only
+    # ones, then *args and **kwargs.
+    extra = nb_positional + nb_kwonly
+    varargs = varkw = None
+    if code.co_flags & CO_VARARGS:
+        varargs = names[extra]
+        extra += 1
+    if code.co_flags & CO_VARKEYWORDS:
+        varkw = names[extra]
+
+    args = CodeArgs(
+        posonlyargs=names[:nb_posonly],
+        args=names[nb_posonly:nb_positional],
+        varargs=varargs,
+        kwonlyargs=names[nb_positional:nb_positional + nb_kwonly],
+        varkw=varkw,
+    )
+    _code_args_cache[code] = args
+    return args
+
+
+def format_args(code, defaults=None, kwdefaults=None):
+    """Renders the parameters of a code object, as in '(a, /, b=1, *, c)'."""
+    args = code_args(code)
+    positional = args.posonlyargs + args.args
+    defaults = defaults or ()
+    kwdefaults = kwdefaults or {}
+    first_default = len(positional) - len(defaults)
+
+    params = []
+    for i, name in enumerate(positional):
+        if i >= first_default:
+            name = '%s=%r' % (name, defaults[i - first_default])
+        params.append(name)
+        if i == len(args.posonlyargs) - 1:
+            params.append('/')
+    if args.varargs:
+        params.append('*%s' % args.varargs)
+    elif args.kwonlyargs:
+        params.append('*')
+    for name in args.kwonlyargs:
+        if name in kwdefaults:
+            name = '%s=%r' % (name, kwdefaults[name])
+        params.append(name)
+    if args.varkw:
+        params.append('**%s' % args.varkw)
+    return '(%s)' % ', '.join(params)
+
+
+def _nested_code_objects(code, seen):
+    """Yields a code object and those nested in it, skipping ids in seen."""
+    pending = [code]
     while pending:
         code = pending.pop(0)
+        if id(code) in seen:
+            continue
+        seen.add(id(code))
         yield code
         for e in code.co_consts:
             if isinstance(e, code.__class__):
                 pending.append(e)
 
-    if function.__closure__:
-        for cell in function.__closure__:
-            cell_value = cell.cell_contents
-            if callable(cell_value):
-                for code in extract_code_objects(cell_value):
-                    yield code
+
+def extract_code_objects(function):
+    """Extracts all code objects from a given function.
+
+    Each function and code object is walked once, so that closures referring
+    to themselves (recursive inner functions) or shared by several paths
+    don't cause endless or repeated walks.
+    """
+    seen = set()  # ids of the functions and code objects already walked
+    pending = [function]
+    while pending:
+        function = pending.pop()
+        if id(function) in seen:
+            continue
+        seen.add(id(function))
+        for code in _nested_code_objects(function.__code__, seen):
+            yield code
+        # Walk the closure depth first, in the order of its cells.
+        pending.extend(reversed([cell_value for _cell_name, cell_value in read_closure(function)
+            if callable(cell_value)]))
+
+
+def read_closure(function):
+    """Takes a snapshot of the closure of a function.
+
+    All cells are read in a single pass, before any of their values is
+    inspected; empty cells (variables not yet bound) are skipped.
+
+    Returns:
+        (str, object) list: the name and value of each non-empty cell.
+    """
+    if not function.__closure__:
+        return []
+
+    snapshot = []
+    for cell_name, cell in zip(function.__code__.co_freevars, function.__closure__):
+        try:
+            snapshot.append((cell_name, cell.cell_contents))
+        except ValueError:  # Empty cell
+            pass
+    return snapshot
+
+
+class CodeIndex(object):
+    """Thread-safe map of code object => function.
+
+    Code objects reachable from several functions are moved to the set of
+    ambiguous code objects.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.code_to_function = {}
+        self.ambiguous_code = set()
+
+    def add(self, function):
+        # Walk the function before taking the lock, only updates are serialized.
+        codes = list(extract_code_objects(function))
+        with self.lock:
+            for code in codes:
+                if code in self.ambiguous_code:
+                    continue
+                elif code in self.code_to_function:
+                    del self.code_to_function[code]
+                    self.ambiguous_code.add(code)
+                else:
+                    self.code_to_function[code] = function
 
 
 def map_code_objects(functions):
     """Creates a map of code object => function."""
-    code_to_function = {}
-    ambiguous_code = set()
+    index = CodeIndex()
     for function in functions:
-        for code in extract_code_objects(function):
-            if code in ambiguous_code:
+        index.add(function)
+    return index.code_to_function, index.ambiguous_code
+
+
+def scan_functions(functions, workers=None, index=None):
+    """Builds the Frame of many functions on a pool of threads.
+
+    Args:
+        functions (function list): the root functions to inspect
+        workers (int): number of threads; defaults to the number of CPUs
+        index (CodeIndex): index shared by all workers, created if None
+
+    Returns:
+        (Frame list, CodeIndex): the frames, in the order of functions, and
+            the index of all code objects found.
+    """
+    from multiprocessing.pool import ThreadPool
+    if index is None:
+        index = CodeIndex()
+
+    def scan(function):
+        index.add(function)
+        return Frame(function)
+
+    pool = ThreadPool(workers)
+    try:
+        frames = pool.map(scan, functions)
+    finally:
+        pool.close()
+        pool.join()
+    return frames, index
+
+
+def _numpy():
+    """Returns the numpy module, or None if it isn't installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class CodeCatalog(object):
+    """Columnar table of code objects, for bulk queries over a codebase.
+
+    Each row describes a code object, as found by walking nested code objects
+    and closures from a set of root functions. Columns are int32 arrays;
+    ``name``, ``filename`` and ``decorator`` hold indices into the ``names``,
+    ``filenames`` and ``decorators`` tables, and ``parent`` the row of the
+    enclosing code object, or of the code holding the function in its
+    closure. -1 stands for no parent or no decorator.
+
+    Queries use numpy when it is installed, plain loops otherwise.
+    """
+
+    COLUMNS = ('name', 'filename', 'firstlineno', 'argcount', 'flags',
+        'freevars', 'parent', 'decorator')
+    STRING_COLUMNS = {'name': 'names', 'filename': 'filenames', 'decorator': 'decorators'}
+
+    MAGIC = b'INSPCAT1'
+    HEADER = struct.Struct('=II')
+
+    def __init__(self, columns, names, filenames, decorators):
+        self.columns = columns
+        self.names = names
+        self.filenames = filenames
+        self.decorators = decorators
+
+    @classmethod
+    def build(cls, functions, decorators=()):
+        """Builds a catalog of all code objects reachable from functions."""
+        columns = dict((column, array.array('i')) for column in cls.COLUMNS)
+        strings = {'names': {}, 'filenames': {}}
+        code_to_decorator = map_code_objects(decorators)[0]
+        decorator_ids = dict((decorator, i) for i, decorator in enumerate(decorators))
+        rows = {}  # id(code) => row
+        seen_functions = set()
+        # Keep walked objects alive, so that their ids stay unique.
+        walked = []
+
+        def intern(table, value):
+            return strings[table].setdefault(value, len(strings[table]))
+
+        def add_code(code, parent):
+            row = len(columns['name'])
+            rows[id(code)] = row
+            walked.append(code)
+            decorator = code_to_decorator.get(code)
+            columns['name'].append(intern('names', code.co_name))
+            columns['filename'].append(intern('filenames', code.co_filename))
+            columns['firstlineno'].append(code.co_firstlineno)
+            columns['argcount'].append(code.co_argcount)
+            columns['flags'].append(code.co_flags)
+            columns['freevars'].append(len(code.co_freevars))
+            columns['parent'].append(parent)
+            columns['decorator'].append(
+                -1 if decorator is None else decorator_ids[decorator])
+            return row
+
+        pending = collections.deque((function, -1) for function in functions)
+        while pending:
+            function, parent = pending.popleft()
+            if id(function) in seen_functions or not hasattr(function, '__code__'):
                 continue
-            elif code in code_to_function:
-                del code_to_function[code]
-                ambiguous_code.add(code)
+            seen_functions.add(id(function))
+            walked.append(function)
+
+            if id(function.__code__) in rows:
+                row = rows[id(function.__code__)]
             else:
-                code_to_function[code] = function
-    return code_to_function, ambiguous_code
+                row = add_code(function.__code__, parent)
+                codes = collections.deque([(function.__code__, row)])
+                while codes:
+                    code, code_row = codes.popleft()
+                    for subcode in code.co_consts:
+                        if isinstance(subcode, code.__class__) and id(subcode) not in rows:
+                            codes.append((subcode, add_code(subcode, code_row)))
+
+            for _cell_name, value in read_closure(function):
+                pending.append((value, row))
+
+        def table(name):
+            return [value for value, _i in sorted(strings[name].items(), key=lambda item: item[1])]
+
+        return cls(columns, table('names'), table('filenames'),
+            [decorator.__name__ for decorator in decorators])
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    def row(self, index):
+        """Returns a row as a dict, with string columns resolved."""
+        return dict((column, self._resolve(column, self.columns[column][index]))
+            for column in self.COLUMNS)
+
+    def _resolve(self, column, value):
+        value = int(value)
+        if column not in self.STRING_COLUMNS or value < 0:
+            return None if column == 'decorator' and value < 0 else value
+        return getattr(self, self.STRING_COLUMNS[column])[value]
+
+    def select(self, flags=0, min_argcount=None, min_freevars=None,
+            filename_prefix=None, decorator=None):
+        """Finds code objects matching all given conditions.
+
+        Args:
+            flags (int): co_flags bits which must all be set, e.g.
+                CO_VARARGS | CO_VARKEYWORDS for '(*args, **kwargs)'
+            min_argcount (int): minimal number of positional parameters
+            min_freevars (int): minimal number of free variables
+            filename_prefix (str): prefix of the file name, e.g. a package path
+            decorator (str): name of the decorator which created the code
+
+        Returns:
+            int list: the matching rows.
+        """
+        filename_ids = None
+        if filename_prefix is not None:
+            filename_ids = [i for i, filename in enumerate(self.filenames)
+                if filename.startswith(filename_prefix)]
+        decorator_id = None
+        if decorator is not None:
+            if decorator not in self.decorators:
+                return []
+            decorator_id = self.decorators.index(decorator)
+
+        numpy = _numpy()
+        if numpy is not None:
+            column = lambda name: numpy.frombuffer(self.columns[name], dtype=numpy.int32)
+            mask = numpy.ones(len(self), dtype=bool)
+            if flags:
+                mask &= (column('flags') & flags) == flags
+            if min_argcount is not None:
+                mask &= column('argcount') >= min_argcount
+            if min_freevars is not None:
+                mask &= column('freevars') >= min_freevars
+            if filename_ids is not None:
+                mask &= numpy.isin(column('filename'), filename_ids)
+            if decorator_id is not None:
+                mask &= column('decorator') == decorator_id
+            return numpy.flatnonzero(mask).tolist()
+
+        if filename_ids is not None:
+            filename_ids = set(filename_ids)
+        columns = self.columns
+        return [i for i in range(len(self))
+            if (columns['flags'][i] & flags) == flags
+            and (min_argcount is None or columns['argcount'][i] >= min_argcount)
+            and (min_freevars is None or columns['freevars'][i] >= min_freevars)
+            and (filename_ids is None or columns['filename'][i] in filename_ids)
+            and (decorator_id is None or columns['decorator'][i] == decorator_id)]
+
+    def group_by(self, column, rows=None):
+        """Counts rows by value of a column, string columns being resolved.
+
+        Returns:
+            dict(value => int): the number of rows for each value.
+        """
+        numpy = _numpy()
+        if numpy is not None:
+            values = numpy.frombuffer(self.columns[column], dtype=numpy.int32)
+            if rows is not None:
+                values = values[numpy.asarray(rows, dtype=numpy.intp)]
+            keys, counts = numpy.unique(values, return_counts=True)
+            return dict((self._resolve(column, key), int(count))
+                for key, count in zip(keys, counts))
+
+        values = self.columns[column]
+        if rows is None:
+            rows = range(len(self))
+        counts = collections.Counter(values[i] for i in rows)
+        return dict((self._resolve(column, key), count) for key, count in counts.items())
+
+    def save(self, path):
+        """Writes the catalog to a file, which load() can memory-map."""
+        import json
+        meta = json.dumps({
+            'names': self.names,
+            'filenames': self.filenames,
+            'decorators': self.decorators,
+            'byteorder': sys.byteorder,
+        }).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.HEADER.pack(len(self), len(meta)))
+            f.write(meta)
+            # Align columns on 8 bytes.
+            f.write(b'\0' * (-f.tell() % 8))
+            for column in self.COLUMNS:
+                array.array('i', self.columns[column]).tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a catalog; columns are views on a read-only memory map."""
+        import json
+        import mmap
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if data[:len(cls.MAGIC)] != cls.MAGIC:
+            raise ValueError("%s is not a code catalog." % path)
+        offset = len(cls.MAGIC)
+        nb_rows, meta_size = cls.HEADER.unpack(data[offset:offset + cls.HEADER.size])
+        offset += cls.HEADER.size
+        meta = json.loads(data[offset:offset + meta_size].decode('utf-8'))
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError("%s was written with a different byte order." % path)
+        offset += meta_size
+        offset += -offset % 8
+
+        columns = {}
+        size = nb_rows * array.array('i').itemsize
+        for column in cls.COLUMNS:
+            try:
+                columns[column] = memoryview(data)[offset:offset + size].cast('i')
+            except AttributeError:  # Python 2, no memoryview.cast
+                columns[column] = array.array('i')
+                columns[column].fromstring(data[offset:offset + size])
+            offset += size
+
+        return cls(columns, meta['names'], meta['filenames'], meta['decorators'])
 
 
 class Frame(object):
-    """Holds information about a decorated function."""
-    def __init__(self, fun):
+    """Holds information about a decorated function.
+
+    With a Budget, subframes beyond its limits aren't built and ``truncated``
+    is set on the frames missing some of their subframes.
+    """
+    def __init__(self, fun, budget=None, _depth=0, _path=()):
         self.fun = fun
         self.subframes = {}
-        self.context = {}
-        for cell_name, cell in self._get_cells():
-            cell_value = cell.cell_contents
-            self.context[cell_name] = cell_value
-            if callable(cell_value):
-                self.subframes[cell_name] = Frame(cell_value)
-
-    def _get_cells(self):
-        if self.fun.__closure__:
-            return zip(self.fun.__code__.co_freevars, self.fun.__closure__)
-        else:
-            return []
+        self.truncated = False
+        # Budget which counted the subframes, if any
+        self.budget = budget
+        self.context = dict(read_closure(fun))
+        # ids of the enclosing functions, which aren't walked again
+        path = _path + (id(fun),)
+        for cell_name, cell_value in self.context.items():
+            if not callable(cell_value) or id(cell_value) in path:
+                continue
+            if budget is not None and not budget.add_node(_depth + 1):
+                self.truncated = True
+                continue
+            self.subframes[cell_name] = Frame(cell_value, budget, _depth + 1, path)
 
     @property
     def argspec(self):
-        return inspect.formatargspec(*inspect.getargspec(self.fun))
+        return format_args(self.fun.__code__, self.fun.__defaults__,
+            getattr(self.fun, '__kwdefaults__', None))
 
-    def render(self, out=None):
-        FunctionPrinter(self.fun, out=out).render()
+    def render(self, out=None, budget=None, source_lines=0):
+        FunctionPrinter(self.fun, out=out, budget=budget, source_lines=source_lines).render()
 
-    def unwrap(self):
+    def unwrap(self, budget=None):
         """Finds all possible decorator chains.
 
+        Args:
+            budget (Budget): optional limits; a chain cut short by the budget
+                ends with a frame which still has subframes.
+
         Yields:
            Frame list: all possible decorator chains.
         """
+        for chain in self._unwrap(budget, 0):
+            if budget is not None and not budget.add_chain():
+                return
+            yield chain
+
+    def _unwrap(self, budget, depth):
         if self.subframes:
             first_frame = self
             for subframe in self.subframes.values():
-                for subchain in subframe.unwrap():
+                if budget is not None and not budget.add_node(depth + 1,
+                        counted=self.budget is budget):
+                    yield [first_frame]
+                    return
+                for subchain in subframe._unwrap(budget, depth + 1):
                     yield [first_frame] + subchain
+        elif self.truncated:
+            # Subframes were cut by a budget, rebuilding would lift its limits.
+            yield [self]
         else:
-            yield [Frame(self.fun)]
+            yield [self.__class__(self.fun)]
 
-    def unwrap_decorators(self, decorators):
+    def unwrap_decorators(self, decorators, budget=None):
         """Finds all possible decorator chains, attaching to known decorators."""
         code_to_decorator, ambiguous_code = map_code_objects(decorators)
         def find_decorator(frame, used_codes):
-            for code in extract_code_objects(frame.fun):
+            for code in frame._code_objects():
                 if code in used_codes:
                     # That code was already used in this chain, we won't reuse
                     # it (would otherwise trigger detection of the first
@@ -220,7 +974,7 @@ class Frame(object):
                     return frame, code_to_decorator[code]
             return frame, None
 
-        for unwrap_chain in self.unwrap():
+        for unwrap_chain in self.unwrap(budget):
             # List code used to match decorators in this chain.
             used_codes = []
             # Since a given code object can match only one decorator, we must
@@ -229,17 +983,38 @@ class Frame(object):
             rev.reverse()
             yield rev
 
-    def find_decorator(self, decorator):
+    def find_decorator(self, decorator, budget=None):
         """Finds all (sub)frames potentially using a given decorator."""
         codes = set(extract_code_objects(decorator))
-        all_frames = [self]
+        all_frames = [(self, 0)]
         while all_frames:
-            frame = all_frames.pop(0)
-            for code in extract_code_objects(frame.fun):
+            frame, depth = all_frames.pop(0)
+            if depth and budget is not None and not budget.add_node(depth,
+                    counted=frame.budget is budget):
+                continue
+            for code in frame._code_objects():
                 if code in codes:
                     yield (frame, code)
                     break
-            all_frames.extend(frame.subframes.values())
+            all_frames.extend((subframe, depth + 1) for subframe in frame.subframes.values())
+
+    def _code_objects(self):
+        """Extracts the code objects of the function and of its subframes.
+
+        Same as extract_code_objects, but only walks the subframes which were
+        built, so that the limits of their budget also apply.
+        """
+        seen = set()  # ids of the functions and code objects already walked
+        pending = [self]
+        while pending:
+            frame = pending.pop()
+            fun = frame.fun
+            if fun is None or id(fun) in seen:  # Dead WeakFrame, or already walked
+                continue
+            seen.add(id(fun))
+            for code in _nested_code_objects(fun.__code__, seen):
+                yield code
+            pending.extend(reversed(list(frame.subframes.values())))
 
     @property
     def function_name(self):
@@ -253,6 +1028,15 @@ class Frame(object):
             return NotImplemented
         return self.fun == other.fun
 
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.fun)
+
     def __repr__(self):
         return '<Frame for %s%s at %s from %s:%d>' % (
             self.function_name,
@@ -263,6 +1047,440 @@ class Frame(object):
         )
 
 
+def dedup_chains(chains):
+    """Removes duplicate chains, keeping the first occurrence of each."""
+    seen = set()
+    for chain in chains:
+        key = tuple(chain)
+        if key not in seen:
+            seen.add(key)
+            yield chain
+
+
+def group_by_code(frames):
+    """Groups distinct frames by the code object of their function.
+
+    Returns:
+        dict(code => Frame list): frames in order of first appearance.
+    """
+    seen = set()
+    groups = collections.OrderedDict()
+    for frame in frames:
+        if frame in seen:
+            continue
+        seen.add(frame)
+        groups.setdefault(frame.fun.__code__, []).append(frame)
+    return groups
+
+
+def common_frames(*chain_lists):
+    """Finds frames shared by the chains of several functions.
+
+    Args:
+        chain_lists: one iterable of chains (as from Frame.unwrap) per function
+
+    Returns:
+        Frame set: frames appearing in the chains of every function.
+    """
+    common = None
+    for chains in chain_lists:
+        frames = set(frame for chain in chains for frame in chain)
+        common = frames if common is None else common & frames
+    return common or set()
+
+
+PASS_THROUGH = 'pass-through'
+TRANSFORMING = 'transforming'
+SIDE_EFFECTING = 'side-effecting'
+
+# Opcodes without effect on the analysis.
+_IGNORED_OPCODES = frozenset([
+    'CACHE', 'COPY_FREE_VARS', 'EXTENDED_ARG', 'MAKE_CELL', 'NOP', 'NOT_TAKEN',
+    'PRECALL', 'PUSH_NULL', 'RESUME',
+])
+
+# Opcodes with effects outside of the wrapper's own frame.
+_SIDE_EFFECT_OPCODES = frozenset([
+    'BEFORE_ASYNC_WITH', 'BEFORE_WITH', 'DELETE_ATTR', 'DELETE_DEREF',
+    'DELETE_GLOBAL', 'DELETE_NAME', 'DELETE_SUBSCR', 'GET_AWAITABLE',
+    'IMPORT_FROM', 'IMPORT_NAME', 'IMPORT_STAR', 'PRINT_EXPR', 'RAISE_VARARGS',
+    'SEND', 'SETUP_ASYNC_WITH', 'SETUP_WITH', 'STORE_ATTR', 'STORE_DEREF',
+    'STORE_GLOBAL', 'STORE_NAME', 'STORE_SLICE', 'STORE_SUBSCR', 'YIELD_FROM',
+    'YIELD_VALUE',
+])
+
+# Code flags of generators and coroutines, whose call doesn't run their body.
+_CO_LAZY = 0x20 | 0x80 | 0x100 | 0x200
+
+
+def _instructions(code):
+    """Lists the meaningful instructions of a code object; None on Python 2."""
+    try:
+        from dis import get_instructions
+    except ImportError:  # Python 2
+        return None
+    return [i for i in get_instructions(code) if i.opname not in _IGNORED_OPCODES]
+
+
+def _forwards_call(instructions, target):
+    """Checks whether bytecode is exactly 'return target(<arguments>)'.
+
+    Runs a symbolic stack over the few opcodes used to forward arguments.
+
+    Returns:
+        (str list, str list): the forwarded positional arguments ('*name' for
+            unpacked ones) and unpacked keyword arguments; None if the code
+            does anything else.
+    """
+    stack = []
+    for instruction in instructions:
+        op, arg, argval = instruction.opname, instruction.arg, instruction.argval
+        try:
+            if op == 'LOAD_DEREF' and argval == target and not stack:
+                stack.append(('target',))
+            elif op.startswith('LOAD_FAST'):
+                names = argval if isinstance(argval, tuple) else (argval,)
+                stack.extend(('fast', name) for name in names)
+            elif op in ('BUILD_LIST', 'BUILD_TUPLE'):
+                items = [stack.pop() for _i in range(arg)][::-1]
+                if any(item[0] != 'fast' for item in items):
+                    return None
+                stack.append(('args', [item[1] for item in items]))
+            elif op == 'LIST_EXTEND' and arg == 1:
+                item = stack.pop()
+                if item[0] != 'fast' or stack[-1][0] != 'args':
+                    return None
+                stack[-1][1].append('*%s' % item[1])
+            elif op == 'LIST_TO_TUPLE' or (
+                    op == 'CALL_INTRINSIC_1' and instruction.argrepr == 'INTRINSIC_LIST_TO_TUPLE'):
+                # Python 3.12+ converts the arguments list through an intrinsic.
+                if stack[-1][0] != 'args':
+                    return None
+            elif op == 'BUILD_TUPLE_UNPACK_WITH_CALL':
+                items = [stack.pop() for _i in range(arg)][::-1]
+                args = []
+                for item in items:
+                    if item[0] == 'args':
+                        args.extend(item[1])
+                    else:
+                        args.append('*%s' % item[1])
+                stack.append(('args', args))
+            elif op == 'BUILD_MAP' and arg == 0:
+                stack.append(('kwargs', []))
+            elif op in ('DICT_MERGE', 'DICT_UPDATE') and arg == 1:
+                item = stack.pop()
+                if item[0] != 'fast' or stack[-1][0] != 'kwargs':
+                    return None
+                stack[-1][1].append(item[1])
+            elif op == 'BUILD_MAP_UNPACK_WITH_CALL':
+                items = [stack.pop() for _i in range(arg)][::-1]
+                if any(item[0] != 'fast' for item in items):
+                    return None
+                stack.append(('kwargs', [item[1] for item in items]))
+            elif op == 'CALL_FUNCTION_EX':
+                kwargs = stack.pop() if arg & 1 else ('kwargs', [])
+                args = stack.pop()
+                if kwargs[0] == 'fast':
+                    kwargs = ('kwargs', [kwargs[1]])
+                if args[0] == 'fast':
+                    args = ('args', ['*%s' % args[1]])
+                if stack.pop() != ('target',) or args[0] != 'args' or kwargs[0] != 'kwargs':
+                    return None
+                stack.append(('result', args[1], kwargs[1]))
+            elif op in ('CALL', 'CALL_FUNCTION'):
+                items = [stack.pop() for _i in range(arg)][::-1]
+                if stack.pop() != ('target',) or any(item[0] != 'fast' for item in items):
+                    return None
+                stack.append(('result', [item[1] for item in items], []))
+            elif op == 'RETURN_VALUE':
+                result = stack.pop()
+                if stack or result[0] != 'result':
+                    return None
+                return result[1], result[2]
+            else:
+                return None
+        except IndexError:
+            return None
+    return None
+
+
+def _has_own_attributes(fun, wrapped):
+    """Checks whether a wrapper carries attributes not copied by functools.wraps.
+
+    Such attributes (e.g. Django's csrf_exempt marker) are read by callers,
+    so the wrapper can't be dropped.
+    """
+    wrapped_dict = getattr(wrapped, '__dict__', {})
+    for name, value in fun.__dict__.items():
+        if name == '__wrapped__':
+            continue
+        if name not in wrapped_dict or wrapped_dict[name] is not value:
+            return True
+    return False
+
+
+def _same_parameters(fun, wrapped):
+    """Checks whether a wrapper accepts exactly the arguments of the wrapped function.
+
+    Either the wrapper only takes '*args, **kwargs', or both functions have the
+    same parameters (names, '*args' and '**kwargs') and the same defaults.
+    """
+    args = code_args(fun.__code__)
+    if not args.posonlyargs and not args.args and args.varargs and args.varkw:
+        return True
+    wrapped_code = getattr(wrapped, '__code__', None)
+    if wrapped_code is None:
+        return False
+    wrapped_args = code_args(wrapped_code)
+    defaults = fun.__defaults__ or ()
+    wrapped_defaults = wrapped.__defaults__ or ()
+    return (args.posonlyargs == wrapped_args.posonlyargs and args.args == wrapped_args.args
+        and bool(args.varargs) == bool(wrapped_args.varargs)
+        and bool(args.varkw) == bool(wrapped_args.varkw)
+        and not args.kwonlyargs and not wrapped_args.kwonlyargs
+        and len(defaults) == len(wrapped_defaults)
+        and all(a is b for a, b in zip(defaults, wrapped_defaults)))
+
+
+def classify_layer(frame, target):
+    """Classifies a wrapper by what it does around calling a closure variable.
+
+    Args:
+        frame (Frame): the wrapper
+        target (str): the closure variable holding the wrapped function
+
+    Returns:
+        str: PASS_THROUGH if the wrapper provably only returns
+            target(*args, **kwargs) with its own, unchanged arguments, accepts
+            the same arguments as target, and has no attributes of its own;
+            TRANSFORMING if it only computes values around calling target;
+            SIDE_EFFECTING otherwise, which is also the safe default when
+            the bytecode can't be analyzed.
+    """
+    code = frame.fun.__code__
+    instructions = _instructions(code)
+    if instructions is None or code.co_flags & _CO_LAZY:
+        return SIDE_EFFECTING
+
+    forwarded = _forwards_call(instructions, target)
+    if forwarded is not None:
+        args = code_args(code)
+        expected = list(args.posonlyargs + args.args)
+        if args.varargs:
+            expected.append('*%s' % args.varargs)
+        expected_kwargs = [args.varkw] if args.varkw else []
+        if not args.kwonlyargs and forwarded == (expected, expected_kwargs):
+            # Removing the wrapper must neither change which calls are
+            # accepted, nor drop attributes read by callers.
+            wrapped = dict(read_closure(frame.fun)).get(target)
+            if _same_parameters(frame.fun, wrapped) and not _has_own_attributes(frame.fun, wrapped):
+                return PASS_THROUGH
+            return TRANSFORMING
+
+    target_loads = 0
+    calls = 0
+    for instruction in instructions:
+        if instruction.opname in _SIDE_EFFECT_OPCODES:
+            return SIDE_EFFECTING
+        if instruction.opname == 'LOAD_DEREF' and instruction.argval == target:
+            target_loads += 1
+        elif instruction.opname.startswith('CALL') and not instruction.opname.startswith('CALL_INTRINSIC'):
+            calls += 1
+    if not target_loads or calls > target_loads:
+        # Doesn't call the wrapped function, or calls something else too.
+        return SIDE_EFFECTING
+    return TRANSFORMING
+
+
+def classify_chain(chain):
+    """Classifies each layer of a chain, as returned by Frame.unwrap.
+
+    Returns:
+        (Frame, str) list: each frame and its kind; None for the innermost one.
+    """
+    result = []
+    for frame, inner in zip(chain, chain[1:]):
+        targets = [name for name, subframe in frame.subframes.items() if subframe == inner]
+        result.append((frame, classify_layer(frame, targets[0]) if targets else SIDE_EFFECTING))
+    if chain:
+        result.append((chain[-1], None))
+    return result
+
+
+def removable_layers(frame):
+    """Finds the pass-through frames in all chains of a frame."""
+    removable = set()
+    for chain in frame.unwrap():
+        removable.update(f for f, kind in classify_chain(chain) if kind == PASS_THROUGH)
+    return removable
+
+
+def _make_cell(value):
+    return (lambda: value).__closure__[0]
+
+
+def _rebuild(fun, replacements):
+    """Copies a function, replacing some of its closure variables."""
+    closure = tuple(
+        _make_cell(replacements[name]) if name in replacements else cell
+        for name, cell in zip(fun.__code__.co_freevars, fun.__closure__))
+    new_fun = types.FunctionType(fun.__code__, fun.__globals__, fun.__name__,
+        fun.__defaults__, closure)
+    new_fun.__dict__.update(fun.__dict__)
+    for attr in ('__doc__', '__module__', '__qualname__', '__kwdefaults__', '__annotations__'):
+        if hasattr(fun, attr):
+            setattr(new_fun, attr, getattr(fun, attr))
+    return new_fun
+
+
+def flatten(fun):
+    """Builds a callable equivalent to fun, skipping pass-through layers.
+
+    Functions are never modified: wrappers which must be kept are copied,
+    with closures pointing to the flattened inner layers.
+    """
+    return _flatten(Frame(fun))
+
+
+def _flatten(frame):
+    for name, subframe in frame.subframes.items():
+        if classify_layer(frame, name) == PASS_THROUGH:
+            return _flatten(subframe)
+
+    replacements = {}
+    for name, subframe in frame.subframes.items():
+        flat = _flatten(subframe)
+        if flat is not subframe.fun:
+            replacements[name] = flat
+    if not replacements:
+        return frame.fun
+    return _rebuild(frame.fun, replacements)
+
+
+class WeakFrame(Frame):
+    """A Frame holding only weak references to its function and context.
+
+    The context isn't stored, but read from the function when requested, so
+    that closure values which can't be weakly referenced (lists, dicts, ...)
+    aren't kept alive by the frame. Subframes whose function is collected by
+    the garbage collector are pruned; once the function itself has been
+    collected, the frame is dead: its context and subframes are empty, and
+    the optional callback is called with it.
+    """
+
+    def __init__(self, fun, callback=None, budget=None, _depth=0, _path=()):
+        self_ref = weakref.ref(self)
+        # Keep the hash stable once the function has been collected.
+        self._hash = hash(fun)
+        self._callback = callback
+        self._fun_ref = weakref.ref(fun, self._on_fun_collected(self_ref))
+        # Weak references to the closure values, to prune collected subframes
+        self._value_refs = {}
+        self.subframes = {}
+        self.truncated = False
+        self.budget = budget
+        path = _path + (id(fun),)
+        for cell_name, cell_value in read_closure(fun):
+            try:
+                self._value_refs[cell_name] = weakref.ref(cell_value,
+                    self._on_value_collected(self_ref, cell_name))
+            except TypeError:  # Not weakly referenceable, read on demand
+                pass
+            if not callable(cell_value) or id(cell_value) in path:
+                continue
+            if budget is not None and not budget.add_node(_depth + 1):
+                self.truncated = True
+                continue
+            self.subframes[cell_name] = WeakFrame(cell_value, budget=budget, _depth=_depth + 1,
+                _path=path)
+
+    @staticmethod
+    def _on_fun_collected(self_ref):
+        def callback(_ref):
+            frame = self_ref()
+            if frame is None:
+                return
+            frame._value_refs.clear()
+            frame.subframes.clear()
+            if frame._callback is not None:
+                frame._callback(frame)
+        return callback
+
+    @staticmethod
+    def _on_value_collected(self_ref, cell_name):
+        def callback(_ref):
+            frame = self_ref()
+            if frame is not None:
+                frame._value_refs.pop(cell_name, None)
+                frame.subframes.pop(cell_name, None)
+        return callback
+
+    @property
+    def fun(self):
+        return self._fun_ref()
+
+    @property
+    def alive(self):
+        return self._fun_ref() is not None
+
+    @property
+    def context(self):
+        fun = self.fun
+        if fun is None:
+            return {}
+        return dict(read_closure(fun))
+
+    @property
+    def argspec(self):
+        if not self.alive:
+            return '(?)'
+        return super(WeakFrame, self).argspec
+
+    @property
+    def function_name(self):
+        if not self.alive:
+            return '<dead function>'
+        return super(WeakFrame, self).function_name
+
+    def render(self, out=None, budget=None, source_lines=0):
+        if not self.alive:
+            (out or sys.stdout).write('%r\n' % self)
+            return
+        super(WeakFrame, self).render(out=out, budget=budget, source_lines=source_lines)
+
+    def _unwrap(self, budget, depth):
+        if not self.alive:
+            yield [self]
+            return
+        for chain in super(WeakFrame, self)._unwrap(budget, depth):
+            yield chain
+
+    def unwrap_decorators(self, decorators, budget=None):
+        if not self.alive:
+            yield [(self, None)]
+            return
+        for chain in super(WeakFrame, self).unwrap_decorators(decorators, budget):
+            yield chain
+
+    def find_decorator(self, decorator, budget=None):
+        if not self.alive:
+            return iter([])
+        return super(WeakFrame, self).find_decorator(decorator, budget)
+
+    def __eq__(self, other):
+        if not self.alive:
+            return self is other
+        return super(WeakFrame, self).__eq__(other)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        if not self.alive:
+            return '<WeakFrame for dead function>'
+        return super(WeakFrame, self).__repr__()
+
+
 class AltFrame(object):
     def __init__(self, fun, cell=None):
         self.cell = cell
@@ -297,6 +1515,124 @@ class AltFrame(object):
         return frames
 
 
+class DecoratorProfiler(object):
+    """Sampling profiler attributing time to decorators.
+
+    A background thread periodically captures the stacks of all other threads;
+    frames running code from a known decorator are named '@decorator' instead
+    of their anonymous wrapper name.
+
+    Samples are counted per collapsed stack (as used by flame graph tools),
+    per decorator, and per chain of consecutive decorator frames. Each sample
+    stands for ``interval`` seconds. Results can be read while sampling.
+
+    Args:
+        decorators (function list): the decorators to recognize
+        interval (float): delay between samples, in seconds
+    """
+
+    def __init__(self, decorators, interval=0.005):
+        self.code_to_decorator = map_code_objects(decorators)[0]
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.decorators = collections.Counter()
+        self.chains = collections.Counter()
+        self._labels = {}  # code => label
+        # Guards the counters, updated by the sampling thread
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _label(self, code):
+        try:
+            return self._labels[code]
+        except KeyError:
+            pass
+        decorator = self.code_to_decorator.get(code)
+        if decorator is not None:
+            label = '@%s' % decorator.__name__
+        else:
+            label = '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+        self._labels[code] = label
+        return label
+
+    def sample(self):
+        """Captures the stacks of all threads but the current one."""
+        current = threading.current_thread().ident
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == current:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+
+            labels = tuple(self._label(code) for code in stack)
+            decorators = set()
+            chains = []
+            chain = []
+            for code in stack + [None]:
+                decorator = self.code_to_decorator.get(code)
+                if decorator is not None:
+                    decorators.add(decorator.__name__)
+                    chain.append(decorator.__name__)
+                elif chain:
+                    chains.append(tuple(chain))
+                    chain = []
+
+            with self._lock:
+                self.stacks[labels] += 1
+                for chain in chains:
+                    self.chains[chain] += 1
+                for decorator in decorators:
+                    self.decorators[decorator] += 1
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='DecoratorProfiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling; does nothing if it wasn't started."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def decorator_times(self):
+        """Estimated time spent within each decorator, in seconds."""
+        with self._lock:
+            return dict((name, count * self.interval) for name, count in self.decorators.items())
+
+    def chain_times(self):
+        """Estimated time spent within each chain of decorators, in seconds."""
+        with self._lock:
+            return dict((chain, count * self.interval) for chain, count in self.chains.items())
+
+    def write_collapsed(self, out=None):
+        """Writes samples in the collapsed stack format of flame graph tools."""
+        out = out or sys.stdout
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        for stack, count in stacks:
+            out.write('%s %d\n' % (';'.join(stack), count))
+
+
 def display(obj, out=None):
     """Display all attributes of an object."""
     if not out:
@@ -324,3 +1660,115 @@ def extract_decorators(fun):
         fun = wrapped
 
     return (decorators, fun)
+
+
+def resolve(target):
+    """Imports an object from a 'module:qualname' string."""
+    import importlib
+    module_name, _sep, qualname = target.partition(':')
+    if not qualname:
+        raise ValueError("Invalid target %r, expected 'module:qualname'" % target)
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _read_targets(path):
+    """Reads targets from a file, one per line; '#' starts a comment."""
+    lines = sys.stdin if path == '-' else open(path)
+    try:
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                yield line
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def _write_json(target, fun, decorators, budget, out):
+    import json
+    chains = []
+    for chain in Frame(fun, budget).unwrap_decorators(decorators, budget):
+        chains.append([
+            {
+                'function': frame.function_name,
+                'file': frame.fun.__code__.co_filename,
+                'line': frame.fun.__code__.co_firstlineno,
+                'decorator': decorator.__name__ if decorator is not None else None,
+            }
+            for frame, decorator in chain
+        ])
+    out.write('%s\n' % json.dumps({
+        'target': target,
+        'chains': chains,
+        'truncated': budget.truncated if budget is not None else None,
+    }, sort_keys=True))
+
+
+def main(argv=None, out=None):
+    """Inspects many 'module:qualname' targets in a single process.
+
+    Returns:
+        int: the exit status; 1 if some targets couldn't be inspected.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m inspector',
+        description="Inspect decorated functions.")
+    parser.add_argument('targets', nargs='*', metavar='module:qualname',
+        help="functions to inspect")
+    parser.add_argument('-f', '--from-file', metavar='PATH',
+        help="read targets from a file, one per line ('-' for stdin)")
+    parser.add_argument('--format', choices=['text', 'json', 'dot'], default='text',
+        help="output format; json writes one object per line")
+    parser.add_argument('-d', '--decorator', action='append', default=[],
+        metavar='module:qualname', help="known decorator, may be repeated")
+    parser.add_argument('--source', type=int, default=0, metavar='N',
+        help="text format: show decorators and the first N lines of each code object")
+    parser.add_argument('--max-nodes', type=int)
+    parser.add_argument('--max-depth', type=int)
+    parser.add_argument('--max-chains', type=int)
+    parser.add_argument('--max-bytes', type=int)
+    parser.add_argument('--timeout', type=float, help="per target, in seconds")
+    args = parser.parse_args(argv)
+
+    out = out or sys.stdout
+    targets = list(args.targets)
+    if args.from_file:
+        try:
+            targets.extend(_read_targets(args.from_file))
+        except (IOError, OSError) as e:
+            parser.error("Can't read targets: %s" % e)
+    if not targets:
+        parser.error("No target given.")
+
+    try:
+        decorators = [resolve(decorator) for decorator in args.decorator]
+    except (ImportError, AttributeError, ValueError) as e:
+        parser.error("Invalid decorator: %s" % e)
+    limits = (args.max_nodes, args.max_depth, args.max_chains, args.max_bytes, args.timeout)
+
+    status = 0
+    for target in targets:
+        try:
+            fun = resolve(target)
+            budget = Budget(*limits) if any(limit is not None for limit in limits) else None
+            if not hasattr(fun, '__code__'):
+                raise TypeError("%r is not a Python function" % (fun,))
+            if args.format == 'json':
+                _write_json(target, fun, decorators, budget, out)
+            elif args.format == 'dot':
+                DotPrinter(fun, decorators, out=out, budget=budget).render()
+            else:
+                FunctionPrinter(fun, out=out, budget=budget, source_lines=args.source).render()
+                out.write('\n')
+        except Exception as e:
+            # Report the failure, and go on with the remaining targets.
+            sys.stderr.write("%s: %s\n" % (target, e))
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
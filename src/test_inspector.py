@@ -2,6 +2,12 @@
 # Copyright (c) 2012 Raphaël Barrois
 
 import functools
+import gc
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
 import sys
 
@@ -168,6 +174,349 @@ class PrinterTestCase(unittest.TestCase):
         self.assertInTimes('Code', out, 2)
         self.assertInTimes('Closure', out, 1)
 
+    def test_source_lines(self):
+        """Test printing the decorators and first lines of source."""
+        def decorator(decorated_fun):
+            @functools.wraps(decorated_fun)
+            def wrapped(*args, **kwargs):
+                return decorated_fun(*args, **kwargs) + 42
+            return wrapped
+
+        @decorator
+        def base_fun():
+            return 42
+
+        inspector.FunctionPrinter(base_fun, out=self.out, source_lines=2).render()
+        out = self.out.getvalue()
+
+        self.assertInTimes('@functools.wraps(decorated_fun)', out, 1)
+        self.assertInTimes('def wrapped(*args, **kwargs):', out, 1)
+        self.assertInTimes('return decorated_fun(*args, **kwargs) + 42', out, 1)
+        self.assertInTimes('@decorator', out, 1)
+        self.assertInTimes('def base_fun():', out, 1)
+        self.assertInTimes('return 42', out, 1)
+        self.assertInTimes('return wrapped', out, 0)
+
+
+class SourceCacheTestCase(unittest.TestCase):
+    """Tests inspector.SourceCache."""
+
+    def setUp(self):
+        source_file = tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False)
+        source_file.write('@decorator(\n    42)\ndef fun():\n    return 1\n')
+        source_file.close()
+        self.path = source_file.name
+        self.addCleanup(os.remove, self.path)
+        self.cache = inspector.SourceCache()
+
+    def compile(self):
+        with open(self.path) as f:
+            module_code = compile(f.read(), self.path, 'exec')
+        return [c for c in module_code.co_consts if isinstance(c, module_code.__class__)][0]
+
+    def test_cached(self):
+        lines = self.cache.getlines(self.path)
+        self.assertEqual(4, len(lines))
+        self.assertIs(lines, self.cache.getlines(self.path))
+
+    def test_reload(self):
+        self.cache.getlines(self.path)
+        with open(self.path, 'a') as f:
+            f.write('# Changed\n')
+        self.assertEqual(5, len(self.cache.getlines(self.path)))
+
+    def test_snippet(self):
+        code = self.compile()
+        self.assertEqual([
+                (1, '@decorator(\n'),
+                (2, '    42)\n'),
+                (3, 'def fun():\n'),
+            ], self.cache.snippet(code, 1))
+        self.assertEqual(4, len(self.cache.snippet(code, 10)))
+
+    def test_missing_file(self):
+        self.assertEqual([], self.cache.getlines('/nonexistent/file.py'))
+
+
+class GraphPrinterTestCase(unittest.TestCase):
+    """Tests DotPrinter and GraphMLPrinter."""
+
+    def setUp(self):
+        self.out = io.StringIO()
+
+    def tearDown(self):
+        self.out.close()
+
+    def test_closure_fun(self):
+        """Test that closure edges are labelled with the variable name."""
+        def enclosed_fun():
+            return 42
+
+        def base_fun():
+            return enclosed_fun()
+
+        inspector.DotPrinter(base_fun, out=self.out).render()
+        out = self.out.getvalue()
+
+        self.assertTrue(out.startswith('digraph inspector {\n'))
+        self.assertTrue(out.endswith('}\n'))
+        self.assertIn('"f%d" -> "f%d" [label="enclosed_fun"];' % (
+            id(base_fun), id(enclosed_fun)), out)
+        self.assertIn('"f%d" -> "c%d";' % (id(base_fun), id(base_fun.__code__)), out)
+
+    def test_shared_nodes(self):
+        """Test that a function reachable from several paths is written once."""
+        def shared():
+            return 42
+
+        def enclosed1():
+            return shared()
+
+        def enclosed2():
+            return shared()
+
+        def base_fun():
+            return enclosed1() + enclosed2()
+
+        inspector.DotPrinter(base_fun, out=self.out).render()
+        out = self.out.getvalue()
+
+        self.assertEqual(1, out.count('\n  "f%d" [' % id(shared)))
+        self.assertEqual(1, out.count('\n  "c%d" [' % id(shared.__code__)))
+        self.assertEqual(2, out.count('-> "f%d"' % id(shared)))
+
+    def test_decorator_tag(self):
+        """Test that nodes created by a known decorator are tagged."""
+        def decorator(decorated_fun):
+            @functools.wraps(decorated_fun)
+            def wrapped(*args, **kwargs):
+                return decorated_fun(*args, **kwargs) + 42
+            return wrapped
+
+        @decorator
+        def base_fun():
+            return 42
+
+        inspector.GraphMLPrinter(base_fun, decorators=[decorator], out=self.out).render()
+        out = self.out.getvalue()
+
+        self.assertEqual(2, out.count('<data key="decorator">decorator</data>'))
+        self.assertIn('<edge source="f%d" target="f%d"><data key="label">decorated_fun</data></edge>' % (
+            id(base_fun), id(base_fun.__closure__[0].cell_contents)), out)
+        self.assertTrue(out.rstrip().endswith('</graphml>'))
+
+
+class BudgetTestCase(unittest.TestCase):
+    """Tests traversals limited by a Budget."""
+
+    def setUp(self):
+        self.out = io.StringIO()
+
+    def tearDown(self):
+        self.out.close()
+
+    def make_chain(self, length):
+        """Builds a function wrapped length times by the same decorator."""
+        def decorator(decorated_fun):
+            @functools.wraps(decorated_fun)
+            def wrapped(*args, **kwargs):
+                return decorated_fun(*args, **kwargs) + 1
+            return wrapped
+
+        def base_fun():
+            return 42
+
+        fun = base_fun
+        for _i in range(length):
+            fun = decorator(fun)
+        return decorator, fun
+
+    def make_fork(self):
+        """Builds a function holding four other functions in its closure."""
+        def fun1():
+            return 1
+
+        def fun2():
+            return 2
+
+        def fun3():
+            return 3
+
+        def fun4():
+            return 4
+
+        def base_fun():
+            return fun1() + fun2() + fun3() + fun4()
+        return base_fun
+
+    def make_diamond(self, levels):
+        """Builds levels of functions, each holding the next one twice."""
+        def make_level(left, right):
+            def level():
+                return left() + right()
+            return level
+
+        def base_fun():
+            return 1
+
+        fun = base_fun
+        for _i in range(levels):
+            fun = make_level(fun, fun)
+        return fun
+
+    def make_recursive(self, decorator):
+        """Builds a decorated function holding itself in its closure."""
+        def enclosing():
+            def fact(n):
+                return n * fact(n - 1) if n else 1
+            return fact
+        return decorator(enclosing())
+
+    def test_unlimited(self):
+        budget = inspector.Budget()
+        _decorator, fun = self.make_chain(5)
+        f = inspector.Frame(fun, budget)
+
+        self.assertEqual(6, len(list(f.unwrap(budget))[0]))
+        self.assertEqual(5, budget.nodes)  # Counted when building only
+        self.assertEqual(1, budget.chains)
+        self.assertIsNone(budget.truncated)
+
+    def test_shared_max_nodes(self):
+        decorator, fun = self.make_chain(5)
+        budget = inspector.Budget(max_nodes=5)
+        f = inspector.Frame(fun, budget)
+
+        self.assertEqual(6, len(list(f.unwrap(budget))[0]))
+        self.assertEqual(6, len(list(f.unwrap_decorators([decorator], budget))[0]))
+        self.assertEqual(5, len(list(f.find_decorator(decorator, budget))))
+        self.assertEqual(5, budget.nodes)
+        self.assertIsNone(budget.truncated)
+
+    def test_shared_timeout(self):
+        _decorator, fun = self.make_chain(5)
+        budget = inspector.Budget(timeout=60)
+        f = inspector.Frame(fun, budget)
+        budget.deadline = 0  # Expires while walking the frame
+
+        self.assertEqual([], list(f.unwrap(budget)))
+        self.assertEqual('timeout', budget.truncated)
+
+    def test_frame_max_depth(self):
+        budget = inspector.Budget(max_depth=2)
+        _decorator, fun = self.make_chain(5)
+        f = inspector.Frame(fun, budget)
+
+        self.assertFalse(f.truncated)
+        subframe = f.subframes['decorated_fun'].subframes['decorated_fun']
+        self.assertTrue(subframe.truncated)
+        self.assertEqual({}, subframe.subframes)
+        self.assertEqual('max_depth', budget.truncated)
+
+    def test_unwrap_max_depth(self):
+        _decorator, fun = self.make_chain(5)
+        f = inspector.Frame(fun)
+        budget = inspector.Budget(max_depth=2)
+
+        chains = list(f.unwrap(budget))
+        self.assertEqual(1, len(chains))
+        self.assertEqual(3, len(chains[0]))
+        self.assertTrue(chains[0][-1].subframes)
+        self.assertEqual('max_depth', budget.truncated)
+
+    def test_unwrap_truncated_frame(self):
+        _decorator, fun = self.make_chain(400)
+        budget = inspector.Budget(max_depth=2)
+        f = inspector.Frame(fun, budget)
+
+        chains = list(f.unwrap(budget))
+        self.assertEqual(1, len(chains))
+        self.assertEqual(3, len(chains[0]))
+        leaf = chains[0][-1]
+        self.assertIs(f.subframes['decorated_fun'].subframes['decorated_fun'], leaf)
+        self.assertTrue(leaf.truncated)
+        self.assertEqual({}, leaf.subframes)
+
+    def test_unwrap_max_chains(self):
+        f = inspector.Frame(self.make_fork())
+        budget = inspector.Budget(max_chains=3)
+
+        self.assertEqual(3, len(list(f.unwrap(budget))))
+        self.assertEqual('max_chains', budget.truncated)
+
+        budget = inspector.Budget(max_chains=3)
+        self.assertEqual(3, len(list(f.unwrap_decorators([], budget))))
+        self.assertEqual('max_chains', budget.truncated)
+
+    def test_find_decorator_max_nodes(self):
+        decorator, fun = self.make_chain(5)
+        f = inspector.Frame(fun)
+        budget = inspector.Budget(max_nodes=2)
+
+        self.assertEqual(3, len(list(f.find_decorator(decorator, budget))))
+        self.assertEqual('max_nodes', budget.truncated)
+
+    def test_find_decorator_diamond(self):
+        decorator, _fun = self.make_chain(1)
+        f = inspector.Frame(decorator(self.make_diamond(40)), inspector.Budget(max_nodes=10))
+        budget = inspector.Budget(timeout=5)
+
+        # Walks of closures missing the decorator are limited by the frames built.
+        self.assertEqual([], list(f.find_decorator(inspector.example2, budget)))
+        chains = list(f.unwrap_decorators([decorator], budget))
+        self.assertTrue(chains)
+        self.assertEqual(set([(decorator,) + (None,) * (len(chain) - 1) for chain in chains]),
+            set(tuple(decorator for _frame, decorator in chain) for chain in chains))
+        self.assertIsNone(budget.truncated)
+
+    def test_find_decorator_recursive(self):
+        decorator, _fun = self.make_chain(1)
+        fun = self.make_recursive(decorator)
+        budget = inspector.Budget(max_depth=3)
+        f = inspector.Frame(fun, budget)
+
+        self.assertEqual([f], [frame for frame, _code in f.find_decorator(decorator, budget)])
+        self.assertEqual([[(f, decorator), (f.subframes['decorated_fun'], None)]],
+            list(f.unwrap_decorators([decorator], budget)))
+
+    def test_timeout(self):
+        budget = inspector.Budget(timeout=-1)
+        _decorator, fun = self.make_chain(5)
+        f = inspector.Frame(fun, budget)
+
+        self.assertTrue(f.truncated)
+        self.assertEqual({}, f.subframes)
+        self.assertEqual('timeout', budget.truncated)
+
+    def test_printer_max_bytes(self):
+        budget = inspector.Budget(max_bytes=200)
+        _decorator, fun = self.make_chain(5)
+        inspector.FunctionPrinter(fun, out=self.out, budget=budget).render()
+        out = self.out.getvalue()
+
+        self.assertEqual('max_bytes', budget.truncated)
+        self.assertTrue(out.endswith('[truncated: max_bytes]\n'))
+        self.assertEqual(1, out.count('truncated'))
+        self.assertTrue(len(out[:out.rindex('\n', 0, -1)]) < 200)
+
+    def test_printer_max_depth(self):
+        budget = inspector.Budget(max_depth=1)
+        _decorator, fun = self.make_chain(5)
+        inspector.FunctionPrinter(fun, out=self.out, budget=budget).render()
+        out = self.out.getvalue()
+
+        self.assertEqual(2, out.count('Function '))
+        self.assertIn('+-> decorated_fun = [truncated: max_depth]', out)
+
+    def test_dot_max_bytes(self):
+        budget = inspector.Budget(max_bytes=100)
+        _decorator, fun = self.make_chain(5)
+        inspector.DotPrinter(fun, out=self.out, budget=budget).render()
+        out = self.out.getvalue()
+
+        self.assertTrue(out.startswith('digraph inspector {\n'))
+        self.assertTrue(out.endswith('  // truncated: max_bytes\n}\n'))
+
 
 class CodeObjectsExtractionTestCase(unittest.TestCase):
     """Tests extract_code_objects and derivatives."""
@@ -222,6 +571,138 @@ class CodeObjectsExtractionTestCase(unittest.TestCase):
         self.assertEqual(fun2, code_map[fun2.__code__])
         self.assertEqual(set([some_fun.__code__]), ambiguous)
 
+    def test_scan_functions(self):
+        """Test scan_functions against Frame and map_code_objects."""
+        def some_fun(foo):
+            return 42
+
+        def fun1(bar):
+            return bar + some_fun(bar)
+
+        def fun2(baz):
+            return baz * some_fun(baz)
+
+        frames, index = inspector.scan_functions([fun1, fun2, some_fun], workers=2)
+
+        self.assertEqual([inspector.Frame(fun1), inspector.Frame(fun2),
+            inspector.Frame(some_fun)], frames)
+        self.assertEqual({fun1.__code__: fun1, fun2.__code__: fun2},
+            index.code_to_function)
+        self.assertEqual(set([some_fun.__code__]), index.ambiguous_code)
+
+    def test_recursive_fun(self):
+        """Test extracting from a function holding itself in its closure."""
+        def enclosing():
+            def fact(n):
+                return n * fact(n - 1) if n else 1
+            return fact
+
+        fact = enclosing()
+        self.assertEqual([fact.__code__], list(inspector.extract_code_objects(fact)))
+        self.assertEqual({}, inspector.Frame(fact).subframes)
+
+    def test_scan_recursive_fun(self):
+        """Test scan_functions with a recursive function among many others."""
+        def enclosing():
+            def fact(n):
+                return n * fact(n - 1) if n else 1
+            return fact
+
+        def some_fun(foo):
+            return 42
+
+        fact = enclosing()
+        frames, index = inspector.scan_functions([some_fun] * 100 + [fact], workers=2)
+
+        self.assertEqual(101, len(frames))
+        self.assertEqual(fact, index.code_to_function[fact.__code__])
+
+    def test_empty_cell(self):
+        """Test extracting from a function whose closure has an empty cell."""
+        def enclosing():
+            def some_fun():
+                return late_fun()
+            return some_fun
+            late_fun = None
+
+        some_fun = enclosing()
+        self.assertEqual([some_fun.__code__], list(inspector.extract_code_objects(some_fun)))
+
+
+class CodeCatalogTestCase(unittest.TestCase):
+    """Tests inspector.CodeCatalog."""
+
+    def setUp(self):
+        self.catalog = inspector.CodeCatalog.build(
+            [inspector.test1, inspector.test2, inspector.test3, inspector.test4],
+            [inspector.example1, inspector.example2])
+
+    def without_numpy(self):
+        numpy = inspector._numpy
+        inspector._numpy = lambda: None
+        self.addCleanup(setattr, inspector, '_numpy', numpy)
+
+    def names(self, rows):
+        return [self.catalog.row(row)['name'] for row in rows]
+
+    def test_build(self):
+        # wrapper1, alt_helper, wrapper2 and the 4 base functions; shared
+        # code objects appear once.
+        self.assertEqual(7, len(self.catalog))
+        wrapper1 = self.catalog.row(0)
+        self.assertEqual('wrapper1', wrapper1['name'])
+        self.assertTrue(wrapper1['filename'].endswith('inspector.py'))
+        self.assertEqual(3, wrapper1['freevars'])
+        self.assertEqual(-1, wrapper1['parent'])
+        self.assertEqual('example1', wrapper1['decorator'])
+
+        alt_helper = self.catalog.row(1)
+        self.assertEqual('alt_helper', alt_helper['name'])
+        self.assertEqual(0, alt_helper['parent'])
+
+        test1 = self.catalog.row(3)
+        self.assertEqual('test1', test1['name'])
+        self.assertEqual(0, test1['parent'])  # In the closure of wrapper1
+        self.assertIsNone(test1['decorator'])
+
+    def test_select(self):
+        wrappers = self.catalog.select(flags=inspector.CO_VARARGS | inspector.CO_VARKEYWORDS)
+        self.assertEqual(['wrapper1', 'wrapper2', 'test3', 'test4'], self.names(wrappers))
+        self.assertEqual(['wrapper1'], self.names(self.catalog.select(
+            flags=inspector.CO_VARARGS | inspector.CO_VARKEYWORDS, min_freevars=2)))
+        self.assertEqual(['wrapper2'], self.names(self.catalog.select(decorator='example2')))
+        self.assertEqual([], self.catalog.select(decorator='missing'))
+        self.assertEqual([], self.catalog.select(filename_prefix='/nonexistent/'))
+        self.assertEqual(7, len(self.catalog.select(min_argcount=0)))
+
+    def test_select_without_numpy(self):
+        self.without_numpy()
+        self.test_select()
+
+    def test_group_by(self):
+        self.assertEqual({'example1': 2, 'example2': 1, None: 4},
+            self.catalog.group_by('decorator'))
+        self.assertEqual({-1: 2, 0: 2, 2: 3}, self.catalog.group_by('parent'))
+        self.assertEqual({'wrapper2': 1, 'test2': 1}, self.catalog.group_by('name', [2, 4]))
+
+    def test_group_by_without_numpy(self):
+        self.without_numpy()
+        self.test_group_by()
+
+    def test_save_load(self):
+        catalog_file = tempfile.NamedTemporaryFile(suffix='.cat', delete=False)
+        catalog_file.close()
+        path = catalog_file.name
+        self.addCleanup(os.remove, path)
+        self.catalog.save(path)
+
+        loaded = inspector.CodeCatalog.load(path)
+        self.assertEqual(len(self.catalog), len(loaded))
+        self.assertEqual([self.catalog.row(i) for i in range(len(self.catalog))],
+            [loaded.row(i) for i in range(len(loaded))])
+        self.assertEqual(self.catalog.select(decorator='example1'),
+            loaded.select(decorator='example1'))
+
 
 class FrameTestCase(unittest.TestCase):
     """Tests inspector.frame-related functions."""
@@ -246,6 +727,43 @@ class FrameTestCase(unittest.TestCase):
         # Equality
         self.assertEqual(f, inspector.Frame(simple_fun))
 
+    def make_function(self, source):
+        """Compiles a function whose syntax may not exist in all versions."""
+        namespace = {}
+        exec(source, namespace)
+        return namespace['base_fun']
+
+    def test_argspec_defaults(self):
+        def base_fun(foo, bar=1, baz='2'):
+            return 42
+
+        f = inspector.Frame(base_fun)
+        self.assertEqual("(foo, bar=1, baz='2')", f.argspec)
+
+    @unittest.skipIf(sys.version_info[0] < 3, "Keyword-only parameters require Python 3")
+    def test_argspec_keyword_only(self):
+        f = inspector.Frame(self.make_function(
+            "def base_fun(foo, *args, bar, baz=2, **kwargs): pass"))
+        self.assertEqual('(foo, *args, bar, baz=2, **kwargs)', f.argspec)
+
+        f = inspector.Frame(self.make_function("def base_fun(foo, *, bar): pass"))
+        self.assertEqual('(foo, *, bar)', f.argspec)
+
+    @unittest.skipIf(sys.version_info < (3, 8), "Positional-only parameters require Python 3.8")
+    def test_argspec_positional_only(self):
+        f = inspector.Frame(self.make_function(
+            "def base_fun(foo, bar=1, /, baz=2, *, qux): pass"))
+        self.assertEqual('(foo, bar=1, /, baz=2, *, qux)', f.argspec)
+
+    def test_argspec_cache(self):
+        def base_fun(foo, *args):
+            return 42
+
+        self.assertIs(inspector.code_args(base_fun.__code__),
+            inspector.code_args(base_fun.__code__))
+        self.assertEqual(('foo',), inspector.code_args(base_fun.__code__).args)
+        self.assertEqual('args', inspector.code_args(base_fun.__code__).varargs)
+
     def test_nested_function(self):
         def base_fun(foo):
             def nested_fun(bar):
@@ -329,6 +847,21 @@ class FrameTestCase(unittest.TestCase):
         # Equality
         self.assertEqual(f, inspector.Frame(base_fun))
 
+    def test_empty_cell(self):
+        """Test a function whose closure holds a not yet assigned variable."""
+        def enclosing():
+            def base_fun():
+                return late_fun()
+            return base_fun
+            late_fun = None
+
+        base_fun = enclosing()
+        f = inspector.Frame(base_fun)
+
+        self.assertEqual({}, f.context)
+        self.assertEqual({}, f.subframes)
+        self.assertEqual([[f]], list(f.unwrap()))
+
     def test_not_wrapping_decorator(self):
         """Test a decorator that simply alters a function object."""
         def decorator(fun):
@@ -583,5 +1116,475 @@ class FrameTestCase(unittest.TestCase):
         self.assertEqual((f2, f2.fun.__code__), res12[1])
 
 
+class FrameSetTestCase(unittest.TestCase):
+    """Tests hashing of frames, and set-based helpers."""
+
+    def setUp(self):
+        def decorator(decorated_fun):
+            @functools.wraps(decorated_fun)
+            def wrapped(*args, **kwargs):
+                return decorated_fun(*args, **kwargs) + 42
+            return wrapped
+
+        def base_fun():
+            return 42
+
+        self.decorator = decorator
+        self.base_fun = base_fun
+        self.decorated1 = decorator(base_fun)
+        self.decorated2 = decorator(base_fun)
+
+    def test_hash(self):
+        f = inspector.Frame(self.decorated1)
+
+        self.assertEqual(hash(f), hash(inspector.Frame(self.decorated1)))
+        self.assertEqual(1, len(set([f, inspector.Frame(self.decorated1)])))
+        self.assertEqual(2, len(set([f, inspector.Frame(self.decorated2)])))
+        self.assertEqual({f: 1}, {inspector.Frame(self.decorated1): 1})
+
+    def test_dedup_chains(self):
+        chains = list(inspector.Frame(self.decorated1).unwrap()) * 3
+        chains += list(inspector.Frame(self.decorated2).unwrap())
+
+        self.assertEqual([chains[0], chains[-1]], list(inspector.dedup_chains(chains)))
+
+    def test_group_by_code(self):
+        frames = [
+            inspector.Frame(self.decorated1),
+            inspector.Frame(self.base_fun),
+            inspector.Frame(self.decorated2),
+            inspector.Frame(self.decorated1),
+        ]
+        groups = inspector.group_by_code(frames)
+
+        self.assertEqual([self.decorated1.__code__, self.base_fun.__code__], list(groups))
+        self.assertEqual([frames[0], frames[2]], groups[self.decorated1.__code__])
+        self.assertEqual([frames[1]], groups[self.base_fun.__code__])
+
+    def test_common_frames(self):
+        chains1 = inspector.Frame(self.decorated1).unwrap()
+        chains2 = inspector.Frame(self.decorated2).unwrap()
+
+        self.assertEqual(set([inspector.Frame(self.base_fun)]),
+            inspector.common_frames(chains1, chains2))
+        self.assertEqual(set(), inspector.common_frames())
+
+
+class PassThroughTestCase(unittest.TestCase):
+    """Tests detection and removal of pass-through wrappers."""
+
+    def pass_through(self, decorated_fun):
+        @functools.wraps(decorated_fun)
+        def forward(*args, **kwargs):
+            return decorated_fun(*args, **kwargs)
+        return forward
+
+    def positional(self, decorated_fun):
+        def forward(request, *args, **kwargs):
+            return decorated_fun(request, *args, **kwargs)
+        return forward
+
+    def same_parameters(self, decorated_fun):
+        def forward(x, *args, **kwargs):
+            return decorated_fun(x, *args, **kwargs)
+        return forward
+
+    def transforming(self, decorated_fun):
+        def double(x, *args, **kwargs):
+            return decorated_fun(x + x, *args, **kwargs)
+        return double
+
+    def side_effecting(self, decorated_fun):
+        calls = []
+        def logged(*args, **kwargs):
+            calls.append(args)
+            return decorated_fun(*args, **kwargs)
+        return logged
+
+    def kinds(self, fun):
+        chains = list(inspector.Frame(fun).unwrap())
+        self.assertEqual(1, len(chains))
+        return [kind for _frame, kind in inspector.classify_chain(chains[0])]
+
+    def test_classify(self):
+        def base_fun(x, y=1):
+            return x + y
+
+        self.assertEqual([inspector.PASS_THROUGH, None],
+            self.kinds(self.pass_through(base_fun)))
+        self.assertEqual([inspector.TRANSFORMING, None],
+            self.kinds(self.positional(base_fun)))
+        self.assertEqual([inspector.TRANSFORMING, None],
+            self.kinds(self.transforming(base_fun)))
+        self.assertEqual([inspector.SIDE_EFFECTING, None],
+            self.kinds(self.side_effecting(base_fun)))
+
+    def test_parameters(self):
+        def base_fun(x, y=1):
+            return x + y
+
+        def forward(x, y=1):
+            return base_fun(x, y)
+
+        def fewer_parameters(x):
+            return base_fun(x)
+
+        def renamed(request, y=1):
+            return base_fun(request, y)
+
+        self.assertEqual([inspector.PASS_THROUGH, None], self.kinds(forward))
+        self.assertEqual([inspector.TRANSFORMING, None], self.kinds(fewer_parameters))
+        self.assertEqual([inspector.TRANSFORMING, None], self.kinds(renamed))
+        # Keyword calls accepted by the wrapper must keep working once flattened.
+        positional = self.positional(base_fun)
+        self.assertEqual(4, inspector.flatten(positional)(request=3))
+        # Named parameters don't match those of a '*args, **kwargs' wrapper.
+        self.assertEqual([inspector.TRANSFORMING, inspector.PASS_THROUGH, None],
+            self.kinds(self.same_parameters(self.pass_through(base_fun))))
+
+    def test_marker_attributes(self):
+        def csrf_exempt(view):
+            def wrapped_view(*args, **kwargs):
+                return view(*args, **kwargs)
+            wrapped_view.csrf_exempt = True
+            return functools.wraps(view)(wrapped_view)
+
+        def base_fun(request):
+            return 42
+        base_fun.public = True
+
+        exempt = csrf_exempt(base_fun)
+        self.assertEqual([inspector.TRANSFORMING, None], self.kinds(exempt))
+        self.assertTrue(inspector.flatten(exempt).csrf_exempt)
+
+        # Attributes copied by functools.wraps don't prevent flattening.
+        wrapped = self.pass_through(base_fun)
+        self.assertEqual([inspector.PASS_THROUGH, None], self.kinds(wrapped))
+        self.assertIs(base_fun, inspector.flatten(wrapped))
+
+    def test_not_forwarding_arguments(self):
+        def base_fun(*args, **kwargs):
+            return 42
+
+        def drop_kwargs(*args, **kwargs):
+            return base_fun(*args)
+
+        def reorder(x, y):
+            return base_fun(y, x)
+
+        def with_default(x=1):
+            return base_fun(x)
+
+        self.assertEqual([inspector.TRANSFORMING, None], self.kinds(drop_kwargs))
+        self.assertEqual([inspector.TRANSFORMING, None], self.kinds(reorder))
+        self.assertEqual([inspector.TRANSFORMING, None], self.kinds(with_default))
+
+    def test_removable_layers(self):
+        def base_fun(x):
+            return x
+
+        inner = self.pass_through(base_fun)
+        middle = self.transforming(inner)
+        outer = self.pass_through(middle)
+
+        self.assertEqual(set([inspector.Frame(outer), inspector.Frame(inner)]),
+            inspector.removable_layers(inspector.Frame(outer)))
+
+    def test_flatten(self):
+        def base_fun(x, y=1):
+            return x + y
+
+        inner = self.pass_through(base_fun)
+        middle = self.transforming(inner)
+        outer = self.pass_through(self.same_parameters(middle))
+        flat = inspector.flatten(outer)
+
+        self.assertEqual(outer(3), flat(3))
+        self.assertEqual(outer(3, y=2), flat(3, y=2))
+        chains = list(inspector.Frame(flat).unwrap())
+        self.assertEqual([[flat.__code__, base_fun.__code__]],
+            [[frame.fun.__code__ for frame in chain] for chain in chains])
+        self.assertEqual(middle.__code__, flat.__code__)
+        self.assertIsNot(middle, flat)
+        # The original chain is left untouched
+        self.assertEqual(5, len(list(inspector.Frame(outer).unwrap())[0]))
+
+    def test_flatten_nothing(self):
+        def base_fun(x):
+            return x
+
+        decorated = self.side_effecting(base_fun)
+        self.assertIs(decorated, inspector.flatten(decorated))
+        self.assertIs(base_fun, inspector.flatten(self.pass_through(base_fun)))
+
+
+class WeakFrameTestCase(unittest.TestCase):
+    """Tests inspector.WeakFrame."""
+
+    class Payload(object):
+        pass
+
+    def make_decorated(self):
+        def decorator(decorated_fun):
+            payload = self.Payload()
+            @functools.wraps(decorated_fun)
+            def wrapped(*args, **kwargs):
+                return decorated_fun(*args, **kwargs) + len([payload])
+            return wrapped
+
+        @decorator
+        def base_fun():
+            return 42
+        return base_fun
+
+    def test_alive(self):
+        """Test a WeakFrame whose function is still referenced."""
+        decorated = self.make_decorated()
+        f = inspector.WeakFrame(decorated)
+
+        self.assertTrue(f.alive)
+        self.assertIs(decorated, f.fun)
+        self.assertEqual(set(['decorated_fun', 'payload']), set(f.context))
+        self.assertEqual(['decorated_fun'], list(f.subframes))
+        self.assertEqual(f, inspector.Frame(decorated))
+        self.assertEqual([[f, f.subframes['decorated_fun']]], list(f.unwrap()))
+
+    def test_collected(self):
+        """Test that a WeakFrame doesn't keep its function alive."""
+        decorated = self.make_decorated()
+        dead = []
+        f = inspector.WeakFrame(decorated, callback=dead.append)
+
+        del decorated
+        gc.collect()
+
+        self.assertFalse(f.alive)
+        self.assertIsNone(f.fun)
+        self.assertEqual([f], dead)
+        self.assertIn(f, set([f]))
+        self.assertNotEqual(f, inspector.WeakFrame(self.make_decorated()))
+        self.assertEqual({}, f.context)
+        self.assertEqual({}, f.subframes)
+        self.assertEqual('<WeakFrame for dead function>', repr(f))
+
+        # Dead frames can still be used
+        self.assertEqual('<dead function>', f.function_name)
+        self.assertEqual('(?)', f.argspec)
+        self.assertEqual([[f]], list(f.unwrap()))
+        self.assertEqual([[(f, None)]], list(f.unwrap_decorators([])))
+        self.assertEqual([], list(f.find_decorator(self.make_decorated)))
+        out = io.StringIO()
+        f.render(out=out)
+        self.assertEqual('<WeakFrame for dead function>\n', out.getvalue())
+
+    def test_strong_values(self):
+        """Test values which can't be weakly referenced."""
+        def enclosing():
+            answer = 42
+            payload = [1, 2, 3]
+            def base_fun():
+                return answer + len(payload)
+            return base_fun
+
+        base_fun = enclosing()
+        f = inspector.WeakFrame(base_fun)
+
+        # Kept while the function is alive
+        self.assertEqual({'answer': 42, 'payload': [1, 2, 3]}, f.context)
+
+        del base_fun
+        gc.collect()
+
+        # Released once it has been collected
+        self.assertFalse(f.alive)
+        self.assertEqual({}, f.context)
+
+    def test_registry_cycle(self):
+        """Test a closure value referring back to the function."""
+        def enclosing():
+            handlers = []
+            def handler():
+                return len(handlers)
+            handlers.append(handler)
+            return handler
+
+        handler = enclosing()
+        f = inspector.WeakFrame(handler)
+        self.assertEqual({'handlers': [handler]}, f.context)
+
+        del handler
+        gc.collect()
+
+        self.assertFalse(f.alive)
+        self.assertEqual({}, f.context)
+
+
+class DecoratorProfilerTestCase(unittest.TestCase):
+    """Tests inspector.DecoratorProfiler."""
+
+    def setUp(self):
+        def decorator1(decorated_fun):
+            @functools.wraps(decorated_fun)
+            def wrapped1(*args, **kwargs):
+                return decorated_fun(*args, **kwargs)
+            return wrapped1
+
+        def decorator2(decorated_fun):
+            @functools.wraps(decorated_fun)
+            def wrapped2(*args, **kwargs):
+                return decorated_fun(*args, **kwargs)
+            return wrapped2
+
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+        @decorator1
+        @decorator2
+        def base_fun():
+            self.started.set()
+            self.release.wait(5)
+
+        self.decorators = [decorator1, decorator2]
+        self.thread = threading.Thread(target=base_fun)
+        self.thread.start()
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.release.set)
+        self.started.wait(5)
+
+    def test_sample(self):
+        profiler = inspector.DecoratorProfiler(self.decorators, interval=0.5)
+        profiler.sample()
+        profiler.sample()
+
+        out = io.StringIO()
+        profiler.write_collapsed(out)
+        stacks = [line for line in out.getvalue().splitlines() if '@decorator1' in line]
+        self.assertEqual(1, len(stacks))
+        self.assertIn(';@decorator1;@decorator2;base_fun (', stacks[0])
+        self.assertTrue(stacks[0].endswith(' 2'))
+        self.assertNotIn('wrapped', out.getvalue())
+
+        self.assertEqual({'decorator1': 1.0, 'decorator2': 1.0}, profiler.decorator_times())
+        self.assertEqual({('decorator1', 'decorator2'): 1.0}, profiler.chain_times())
+
+    def test_background(self):
+        with inspector.DecoratorProfiler(self.decorators, interval=0.001) as profiler:
+            for _i in range(5000):
+                if profiler.decorators:
+                    break
+                time.sleep(0.001)
+
+        self.assertIn('decorator1', profiler.decorators)
+        self.assertIn('decorator2', profiler.decorators)
+
+    def test_read_while_sampling(self):
+        with inspector.DecoratorProfiler(self.decorators, interval=0.0001) as profiler:
+            times = {}
+            for _i in range(5000):
+                if 'decorator1' in times and profiler.stacks:
+                    break
+                times = profiler.decorator_times()
+                profiler.chain_times()
+                profiler.write_collapsed(io.StringIO())
+
+        self.assertIn('decorator1', times)
+
+    def test_stop_not_started(self):
+        profiler = inspector.DecoratorProfiler(self.decorators)
+        profiler.stop()
+        profiler.start()
+        profiler.stop()
+        profiler.stop()
+
+
+class MainTestCase(unittest.TestCase):
+    """Tests the command line tool."""
+
+    def setUp(self):
+        self.out = io.StringIO()
+        self.stderr = sys.stderr
+        sys.stderr = io.StringIO()
+
+    def tearDown(self):
+        self.out.close()
+        sys.stderr = self.stderr
+
+    def test_text(self):
+        status = inspector.main(['inspector:test1', 'inspector:test2'], out=self.out)
+        out = self.out.getvalue()
+
+        self.assertEqual(0, status)
+        self.assertIn('Function test1 at %d' % id(inspector.test1), out)
+        self.assertIn('Function test2 at %d' % id(inspector.test2), out)
+
+    def test_json(self):
+        status = inspector.main(['--format', 'json', '-d', 'inspector:example1',
+            '-d', 'inspector:example2', 'inspector:test3'], out=self.out)
+        result = json.loads(self.out.getvalue())
+
+        self.assertEqual(0, status)
+        self.assertEqual('inspector:test3', result['target'])
+        self.assertEqual([['example1', 'example2', None]],
+            [[frame['decorator'] for frame in chain] for chain in result['chains']])
+        self.assertIsNone(result['truncated'])
+
+    def test_dot(self):
+        status = inspector.main(['--format', 'dot', 'inspector:test1', 'inspector:test2'],
+            out=self.out)
+
+        self.assertEqual(0, status)
+        self.assertEqual(2, self.out.getvalue().count('digraph inspector {'))
+
+    def test_from_file(self):
+        targets = tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False)
+        self.addCleanup(os.remove, targets.name)
+        targets.write('# Targets\ninspector:test1\n\ninspector:test2  # Second\n')
+        targets.close()
+
+        status = inspector.main(['--format', 'json', '-f', targets.name], out=self.out)
+        lines = self.out.getvalue().splitlines()
+
+        self.assertEqual(0, status)
+        self.assertEqual(['inspector:test1', 'inspector:test2'],
+            [json.loads(line)['target'] for line in lines])
+
+    def test_missing_file(self):
+        with self.assertRaises(SystemExit) as raised:
+            inspector.main(['-f', os.path.join(tempfile.gettempdir(), 'missing', 'targets.txt')],
+                out=self.out)
+
+        self.assertEqual(2, raised.exception.code)
+        self.assertIn("Can't read targets", sys.stderr.getvalue())
+
+    def test_invalid_target(self):
+        status = inspector.main(['--format', 'json', 'inspector:missing', 'inspector',
+            'inspector:test1'], out=self.out)
+
+        self.assertEqual(1, status)
+        self.assertEqual(1, len(self.out.getvalue().splitlines()))
+        self.assertEqual(2, len(sys.stderr.getvalue().splitlines()))
+
+    def test_unsupported_target(self):
+        for format in ('text', 'json', 'dot'):
+            sys.stderr = io.StringIO()
+            status = inspector.main(['--format', format, 'os:getcwd', 'collections:OrderedDict',
+                'inspector:test1'], out=self.out)
+
+            self.assertEqual(1, status)
+            self.assertEqual(['os:getcwd', 'collections:OrderedDict'],
+                [line.split(': ')[0] for line in sys.stderr.getvalue().splitlines()])
+        self.assertIn('inspector:test1', self.out.getvalue())
+
+    def test_json_budget(self):
+        # The frames of the three layers must be counted once, not twice
+        status = inspector.main(['--format', 'json', '--max-nodes', '3', 'inspector:test3'],
+            out=self.out)
+        result = json.loads(self.out.getvalue())
+
+        self.assertEqual(0, status)
+        self.assertIsNone(result['truncated'])
+        self.assertEqual([3], [len(chain) for chain in result['chains']])
+
+
 if __name__ == '__main__':
     unittest.main()